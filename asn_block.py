@@ -18,17 +18,23 @@ ufw is only implemented as a theoretical exercise.
 """
 
 import os
-import re
-import gzip
-import shutil
-import ipaddress
+import mmap
+import zlib
+import sys
+import json
+import shlex
+import pickle
+import functools
+import socket
+import struct
 import argparse
 import logging
 import requests
 import logging.handlers
 import subprocess
 from pathlib import Path
-from typing import Generator, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Generator, List, Optional, Tuple
 
 # Configure syslog logging
 logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -41,20 +47,27 @@ BIN_SYSTEMCTL = "/bin/systemctl"
 BIN_FIREWALL_CMD = "/usr/bin/firewall-cmd"
 BIN_UFW = "/usr/sbin/ufw"
 BIN_IPSET = "/sbin/ipset"
-BIN_IPTABLES = "/sbin/iptables"
-BIN_IP6TABLES = "/sbin/ip6tables"
+BIN_IPTABLES_RESTORE = "/sbin/iptables-restore"
+BIN_IP6TABLES_RESTORE = "/sbin/ip6tables-restore"
 
 # URLs and paths
 IPTOASN_V4_URL = "https://iptoasn.com/data/ip2asn-v4.tsv.gz"
 IPTOASN_V6_URL = "https://iptoasn.com/data/ip2asn-v6.tsv.gz"
+URLS = {
+    "v4": IPTOASN_V4_URL,
+    "v6": IPTOASN_V6_URL
+}
 DATA_DIR = Path("/var/tmp/iptoasn_cache")
 FILES = {
     "v4": DATA_DIR / "ip2asn-v4.tsv",
     "v6": DATA_DIR / "ip2asn-v6.tsv"
 }
 
-def is_service_active(service: str) -> bool:
-    return subprocess.run([BIN_SYSTEMCTL, "is-active", "--quiet", service]).returncode == 0
+def are_services_active(*services: str) -> list[bool]:
+    # One systemctl call for all units; it prints one state per unit, in the order given
+    result = subprocess.run([BIN_SYSTEMCTL, "is-active", *services], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    states = result.stdout.splitlines()
+    return [i < len(states) and states[i] == "active" for i in range(len(services))]
 
 def ensure_data_dir() -> None:
     DATA_DIR.mkdir(parents=True, exist_ok=True)
@@ -62,24 +75,78 @@ def ensure_data_dir() -> None:
 def validate_asn(asn: int) -> bool:
     return isinstance(asn, int) and 0 < asn < 4294967295
 
-def download_file(url: str, out_path: Path) -> None:
-    gz_path = out_path.with_suffix(".tsv.gz")
-    with requests.get(url, stream=True, timeout=10) as r:
+def validators_path_for(file_path: Path) -> Path:
+    return file_path.with_suffix(".etag")
+
+def download_file(session: requests.Session, url: str, out_path: Path) -> Optional[Dict[str, str]]:
+    # Inflate the response as it streams in, straight into the dataset, no .gz on disk.
+    # Malformed rows are skipped by the readers rather than regex-filtered here.
+    # Returns None when the server says our copy is still current (304), otherwise
+    # the new ETag/Last-Modified; the caller saves those once the dataset is usable.
+    validators_path = validators_path_for(out_path)
+    headers = {}
+    if out_path.exists() and validators_path.exists():
+        try:
+            validators = json.loads(validators_path.read_text())
+        except ValueError:
+            # Unreadable cache entry: fall back to an unconditional download
+            validators = {}
+        if not isinstance(validators, dict):
+            validators = {}
+        if "ETag" in validators:
+            headers["If-None-Match"] = validators["ETag"]
+        if "Last-Modified" in validators:
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+    with session.get(url, stream=True, timeout=10, headers=headers) as r:
+        if r.status_code == 304:
+            return None
         r.raise_for_status()
-        with open(gz_path, "wb") as f:
-            shutil.copyfileobj(r.raw, f)
-    with gzip.open(gz_path, "rt") as f_in, open(out_path, "w") as f_out:
-        for line in f_in:
-            if re.match(r"^\S+\t\S+\t\d+(?:\t.+)?$", line.strip()):
-                f_out.write(line)
-    os.remove(gz_path)
+        # Written next to the dataset and renamed over it only once complete, so an
+        # interrupted download never replaces a good dataset (the rename costs no extra I/O)
+        part_path = out_path.with_suffix(".part")
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            with open(part_path, "wb", buffering=1 << 20) as f_out:
+                for chunk in r.iter_content(1 << 20):
+                    f_out.write(decompressor.decompress(chunk))
+                    # gzip allows several concatenated members; start over on the next one
+                    while decompressor.eof and decompressor.unused_data:
+                        chunk = decompressor.unused_data
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        f_out.write(decompressor.decompress(chunk))
+                if not decompressor.eof:
+                    raise EOFError(f"Truncated gzip stream from {url}")
+        except BaseException:
+            part_path.unlink(missing_ok=True)
+            raise
+        part_path.replace(out_path)
+        return {k: r.headers[k] for k in ("ETag", "Last-Modified") if k in r.headers}
+
+def update_dataset(version: str) -> None:
+    logger.info(f"Downloading IP{version} dataset...")
+    # A session per worker: requests doesn't promise Session is thread-safe. The .gz is
+    # already compressed, so ask for it as-is rather than re-encoded.
+    with requests.Session() as session:
+        session.headers["Accept-Encoding"] = "identity"
+        validators = download_file(session, URLS[version], FILES[version])
+    if validators is not None or usable_index(FILES[version])[0] is None:
+        logger.info(f"Indexing IP{version} dataset...")
+        build_index(FILES[version], version == "v6")
+    else:
+        logger.info(f"IP{version} dataset is already up to date.")
+    # Only now, so an interrupted index build is retried by the next update instead of
+    # a 304 leaving the old index in use
+    if validators is not None:
+        validators_path = validators_path_for(FILES[version])
+        validators_part = validators_path.with_name(validators_path.name + ".part")
+        validators_part.write_text(json.dumps(validators))
+        validators_part.replace(validators_path)
 
 def update_datasets() -> None:
     ensure_data_dir()
-    logger.info("Downloading IPv4 dataset...")
-    download_file(IPTOASN_V4_URL, FILES["v4"])
-    logger.info("Downloading IPv6 dataset...")
-    download_file(IPTOASN_V6_URL, FILES["v6"])
+    # The two downloads are independent and network-bound, and write to different files
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(update_dataset, ["v4", "v6"]))
     logger.info("Datasets updated.")
 
 def ensure_datasets() -> None:
@@ -87,25 +154,165 @@ def ensure_datasets() -> None:
         logger.warning("Datasets missing, downloading now...")
         update_datasets()
 
-def parse_dataset(file_path: Path, asn: int) -> Generator[Tuple[str, str], None, None]:
-    with open(file_path, "r") as f:
+def index_paths_for(file_path: Path) -> Tuple[Path, Path]:
+    return file_path.with_suffix(".bin"), file_path.with_suffix(".off")
+
+def build_index(file_path: Path, v6: bool = False) -> None:
+    # One pass over the TSV so block/unblock never parse it. The .bin file holds
+    # fixed-width (start, end) records in network byte order, grouped by ASN in
+    # ASN order; the small .off file maps ASN -> (byte offset, record count) and
+    # records the .bin size it was written with.
+    # Every row is kept here, so let the C-level text decoder and a single bounded
+    # split do the work rather than per-field partition/decode calls.
+    family = socket.AF_INET6 if v6 else socket.AF_INET
+    inet_pton = socket.inet_pton
+    ranges: Dict[int, List[bytes]] = {}
+    with open(file_path, "r", encoding="utf-8", errors="replace", buffering=1 << 20) as f:
         for line in f:
-            if line.startswith("#") or line.strip() == "":
+            fields = line.split("\t", 3)
+            # str.isdigit() also accepts non-ASCII digits such as "\u00b2" that int() rejects
+            record_asn = fields[2].strip() if len(fields) >= 3 else ""
+            if not (record_asn.isascii() and record_asn.isdigit()):
                 continue
-            parts = line.strip().split("\t")
-            start, end, record_asn = parts[0], parts[1], parts[2]
-            if record_asn == str(asn):
-                yield (start, end)
-
-def iprange_to_cidr(start_ip: str, end_ip: str) -> ipaddress._BaseNetwork:
-    start = ipaddress.ip_address(start_ip)
-    end = ipaddress.ip_address(end_ip)
-    return ipaddress.summarize_address_range(start, end)
-
+            try:
+                record = inet_pton(family, fields[0]) + inet_pton(family, fields[1])
+            except (OSError, ValueError):
+                continue
+            ranges.setdefault(int(record_asn), []).append(record)
+    bin_path, offsets_path = index_paths_for(file_path)
+    bin_part = bin_path.with_name(bin_path.name + ".part")
+    offsets_part = offsets_path.with_name(offsets_path.name + ".part")
+    offsets: Dict[int, Tuple[int, int]] = {}
+    try:
+        with open(bin_part, "wb") as f:
+            for asn in sorted(ranges):
+                offsets[asn] = (f.tell(), len(ranges[asn]))
+                f.write(b"".join(ranges[asn]))
+            bin_size = f.tell()
+        with open(offsets_part, "wb") as f:
+            pickle.dump({"bin_size": bin_size, "offsets": offsets}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Swap in whole files so a concurrent block never sees a half-written index (and an
+        # already mapped .bin keeps its old inode). .bin goes first and .off last; readers
+        # only trust a .bin whose size matches the .off they loaded.
+        bin_part.replace(bin_path)
+        offsets_part.replace(offsets_path)
+    except BaseException:
+        bin_part.unlink(missing_ok=True)
+        offsets_part.unlink(missing_ok=True)
+        raise
+    load_index.cache_clear()
+
+@functools.lru_cache(maxsize=None)
+def load_index(offsets_path: Path) -> Optional[Dict]:
+    if not offsets_path.exists():
+        return None
+    with open(offsets_path, "rb") as f:
+        index = pickle.load(f)
+    # Older .off files were a bare offsets dict without the .bin size; rebuild those
+    if not isinstance(index, dict) or "bin_size" not in index:
+        return None
+    return index
+
+def usable_index(file_path: Path) -> Tuple[Optional[Dict], Optional[str]]:
+    # (index, None) when the .off loads and the .bin exists with the size it records.
+    # Otherwise (None, reason), with reason None when there simply is no index yet.
+    bin_path, offsets_path = index_paths_for(file_path)
+    index = load_index(offsets_path)
+    if index is None:
+        return None, None
+    try:
+        bin_size = bin_path.stat().st_size
+    except FileNotFoundError:
+        return None, f"{bin_path.name} is missing"
+    if bin_size != index["bin_size"]:
+        return None, f"{bin_path.name} does not match {offsets_path.name}"
+    return index, None
+
+def parse_dataset(file_path: Path, asn: int, v6: bool = False) -> Generator[Tuple[int, int], None, None]:
+    bin_path, offsets_path = index_paths_for(file_path)
+    index, problem = usable_index(file_path)
+    if index is not None:
+        try:
+            with open(bin_path, "rb") as f:
+                # Checked again on the open file in case an update swapped it in meanwhile
+                if os.fstat(f.fileno()).st_size == index["bin_size"]:
+                    if asn not in index["offsets"]:
+                        return
+                    offset, count = index["offsets"][asn]
+                    size = 16 if v6 else 4
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        for pos in range(offset, offset + count * 2 * size, 2 * size):
+                            yield (int.from_bytes(mm[pos:pos + size], "big"), int.from_bytes(mm[pos + size:pos + 2 * size], "big"))
+                    return
+            problem = f"{bin_path.name} does not match {offsets_path.name}"
+        except FileNotFoundError:
+            problem = f"{bin_path.name} is missing"
+    if problem is not None:
+        # The TSV is replaced before its index, so it is the consistent copy mid-update
+        logger.warning(f"{problem}, scanning {file_path.name} instead")
+    # Compare raw bytes; only matching rows get decoded
+    asn_bytes = str(asn).encode()
+    with open(file_path, "rb") as f:
+        for line in f:
+            if line[:1] in (b"#", b"\n"):
+                continue
+            start, _, rest = line.partition(b"\t")
+            end, _, rest = rest.partition(b"\t")
+            if rest.partition(b"\t")[0].rstrip() == asn_bytes:
+                # Skip rows build_index would skip, so both paths return the same ranges
+                try:
+                    record = (ip_to_int(start.decode(), v6), ip_to_int(end.decode(), v6))
+                except (OSError, ValueError):
+                    continue
+                yield record
+
+def ip_to_int(ip: str, v6: bool = False) -> int:
+    # inet_pton rather than inet_aton: same C speed, but rejects shorthand like "10.1"
+    return int.from_bytes(socket.inet_pton(socket.AF_INET6 if v6 else socket.AF_INET, ip), "big")
+
+def int_to_ip(value: int, v6: bool = False) -> str:
+    if v6:
+        return socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, "big"))
+    return socket.inet_ntoa(struct.pack("!I", value))
+
+def summarize_int(start_int: int, end_int: int, v6: bool = False) -> Generator[Tuple[int, int], None, None]:
+    # Same result as ipaddress.summarize_address_range, on plain ints: take the largest
+    # block that is aligned on start_int and does not run past end_int, then advance.
+    width = 128 if v6 else 32
+    while start_int <= end_int:
+        align = (start_int & -start_int).bit_length() - 1 if start_int else width
+        nbits = min(align, (end_int - start_int + 1).bit_length() - 1)
+        yield (start_int, width - nbits)
+        start_int += 1 << nbits
+
+@functools.lru_cache(maxsize=1 << 16)
+def summarize_cached(start_int: int, end_int: int, v6: bool = False) -> Tuple[str, ...]:
+    # Memoized for callers that block many ASNs in one process, where the same ranges recur
+    return tuple(f"{int_to_ip(net, v6)}/{prefix_len}" for net, prefix_len in summarize_int(start_int, end_int, v6))
+
+def merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+def collect_cidrs(version: str, asn: int) -> list[str]:
+    # Coalesce touching/overlapping ranges first so they summarize into fewer, shorter prefixes
+    v6 = version == "v6"
+    ranges = list(parse_dataset(FILES[version], asn, v6))
+    merged = merge_ranges(ranges)
+    cidr_list = [cidr for start, end in merged for cidr in summarize_cached(start, end, v6)]
+    logger.info(f"ASN{asn} {version}: merged {len(ranges)} ranges into {len(merged)}, {len(cidr_list)} CIDRs")
+    return cidr_list
+
+@functools.lru_cache(maxsize=1)
 def detect_firewall_backend() -> str:
-    firewalld = is_service_active("firewalld")
-    ufw = is_service_active("ufw")
-    ipt = is_service_active("iptables") or is_service_active("ip6tables")
+    firewalld, ufw, iptables, ip6tables = are_services_active("firewalld", "ufw", "iptables", "ip6tables")
+    ipt = iptables or ip6tables
     if sum([firewalld, ufw, ipt]) > 1:
         logger.error("Multiple conflicting firewall systems detected. Please ensure only one is active.")
         return "conflict"
@@ -117,77 +324,82 @@ def detect_firewall_backend() -> str:
         return "iptables"
     return "unknown"
 
-def create_or_reset_ipset(ipset_name: str, version: str, dry_run: bool) -> None:
-    result = subprocess.run([BIN_IPSET, "list", ipset_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    if result.returncode == 0:
-        if dry_run:
-            print(f"[DRY-RUN] Would run: {BIN_IPSET} destroy {ipset_name}")
-        else:
-            subprocess.run([BIN_IPSET, "destroy", ipset_name], stderr=subprocess.DEVNULL)
-    cmd = [BIN_IPSET, "create", ipset_name, "hash:net", "family", "inet6" if version == "v6" else "inet"]
+def populate_ipset(ipset_name: str, version: str, cidr_list: list[str], dry_run: bool = False) -> None:
+    # Create (if missing), empty and refill the set with a single ipset restore,
+    # instead of separate list/destroy/create calls plus one ipset add per CIDR
+    cmd = [BIN_IPSET, "restore", "-exist"]
+    family = "inet6" if version == "v6" else "inet"
+    restore_input = f"create {ipset_name} hash:net family {family}\nflush {ipset_name}\n"
+    restore_input += "".join(f"add {ipset_name} {cidr}\n" for cidr in cidr_list)
     if dry_run:
-        print(f"[DRY-RUN] Would run: {' '.join(cmd)}")
+        print(f"[DRY-RUN] Would run: {shlex.join(cmd)} with input:")
+        print(restore_input, end="")
     else:
-        subprocess.run(cmd, stderr=subprocess.DEVNULL)
-
-def add_ip_to_ipset(ipset_name: str, cidr: str, dry_run: bool = False) -> None:
-    cmd = [BIN_IPSET, "add", ipset_name, cidr]
-    if dry_run:
-        print(f"[DRY-RUN] Would run: {' '.join(cmd)}")
-    else:
-        subprocess.run(cmd, stderr=subprocess.DEVNULL)
+        # restore stops at the first failing line, so anything after it is not loaded; this
+        # includes an existing set of another type/family, which -exist will not replace
+        result = subprocess.run(cmd, input=restore_input, text=True, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            logger.error(f"ipset restore for {ipset_name} failed, the set may be empty or incomplete: {result.stderr.strip()}")
 
 def apply_firewalld_rule(ipset_name: str, dry_run: bool = False) -> None:
     zone = "block"
     cmd_add = [BIN_FIREWALL_CMD, "--permanent", f"--zone={zone}", "--add-source=ipset:" + ipset_name]
-    cmd_reload = [BIN_FIREWALL_CMD, "--reload"]
     if dry_run:
-        print(f"[DRY-RUN] Would run: {' '.join(cmd_add)}")
-        print(f"[DRY-RUN] Would run: {' '.join(cmd_reload)}")
+        print(f"[DRY-RUN] Would run: {shlex.join(cmd_add)}")
     else:
         subprocess.run(cmd_add)
-        subprocess.run(cmd_reload)
 
 def remove_firewalld_rule(ipset_name: str, dry_run: bool = False) -> None:
     zone = "block"
     cmd_del = [BIN_FIREWALL_CMD, "--permanent", f"--zone={zone}", "--remove-source=ipset:" + ipset_name]
-    cmd_reload = [BIN_FIREWALL_CMD, "--reload"]
     if dry_run:
-        print(f"[DRY-RUN] Would run: {' '.join(cmd_del)}")
-        print(f"[DRY-RUN] Would run: {' '.join(cmd_reload)}")
+        print(f"[DRY-RUN] Would run: {shlex.join(cmd_del)}")
     else:
         subprocess.run(cmd_del)
+
+def reload_firewalld(dry_run: bool = False) -> None:
+    # Reloading is the slow part, so callers queue all --permanent changes and reload once
+    cmd_reload = [BIN_FIREWALL_CMD, "--reload"]
+    if dry_run:
+        print(f"[DRY-RUN] Would run: {shlex.join(cmd_reload)}")
+    else:
         subprocess.run(cmd_reload)
 
 def apply_ufw_rule(cidr_list: list[str], dry_run: bool = False) -> None:
-    for cidr in cidr_list:
-        rule = [BIN_UFW, "deny", "from", cidr]
-        if dry_run:
-            print(f"[DRY-RUN] Would run: {' '.join(rule)}")
-        else:
-            subprocess.run(rule)
+    rules = [[BIN_UFW, "deny", "from", cidr] for cidr in cidr_list]
+    if dry_run:
+        # One write for the whole list rather than a print per CIDR
+        sys.stdout.write("".join(f"[DRY-RUN] Would run: {shlex.join(rule)}\n" for rule in rules))
+        return
+    for rule in rules:
+        subprocess.run(rule)
 
 def remove_ufw_rule(cidr_list: list[str], dry_run: bool = False) -> None:
-    for cidr in cidr_list:
-        rule = [BIN_UFW, "delete", "deny", "from", cidr]
-        if dry_run:
-            print(f"[DRY-RUN] Would run: {' '.join(rule)}")
-        else:
-            subprocess.run(rule)
-
-def apply_iptables_rule(cmd_path: str, ipset_name: str, dry_run: bool = False) -> None:
-    rule = [cmd_path, "-I", "INPUT", "-m", "set", "--match-set", ipset_name, "src", "-j", "DROP"]
+    rules = [[BIN_UFW, "delete", "deny", "from", cidr] for cidr in cidr_list]
     if dry_run:
-        print(f"[DRY-RUN] Would run: {' '.join(rule)}")
-    else:
-        subprocess.run(rule, stderr=subprocess.DEVNULL)
-
-def remove_iptables_rule(cmd_path: str, ipset_name: str, dry_run: bool = False) -> None:
-    rule = [cmd_path, "-D", "INPUT", "-m", "set", "--match-set", ipset_name, "src", "-j", "DROP"]
+        sys.stdout.write("".join(f"[DRY-RUN] Would run: {shlex.join(rule)}\n" for rule in rules))
+        return
+    for rule in rules:
+        subprocess.run(rule)
+
+def run_iptables_restore(cmd_path: str, rules: list[str], dry_run: bool = False) -> None:
+    # One restore call commits the whole batch in a single transaction (and takes the
+    # xtables lock once); --noflush leaves every other rule in the filter table alone
+    cmd = [cmd_path, "--noflush"]
+    restore_input = "*filter\n" + "".join(f"{rule}\n" for rule in rules) + "COMMIT\n"
     if dry_run:
-        print(f"[DRY-RUN] Would run: {' '.join(rule)}")
+        print(f"[DRY-RUN] Would run: {shlex.join(cmd)} with input:")
+        print(restore_input, end="")
     else:
-        subprocess.run(rule, stderr=subprocess.DEVNULL)
+        subprocess.run(cmd, input=restore_input, text=True, stderr=subprocess.DEVNULL)
+
+def apply_iptables_rules(cmd_path: str, ipset_names: list[str], dry_run: bool = False) -> None:
+    rules = [f"-I INPUT -m set --match-set {ipset_name} src -j DROP" for ipset_name in ipset_names]
+    run_iptables_restore(cmd_path, rules, dry_run=dry_run)
+
+def remove_iptables_rules(cmd_path: str, ipset_names: list[str], dry_run: bool = False) -> None:
+    rules = [f"-D INPUT -m set --match-set {ipset_name} src -j DROP" for ipset_name in ipset_names]
+    run_iptables_restore(cmd_path, rules, dry_run=dry_run)
 
 def create_ipset_and_rules(asn: int, dry_run: bool = False) -> None:
     print("--- Creating block rules ---")
@@ -206,24 +418,20 @@ def create_ipset_and_rules(asn: int, dry_run: bool = False) -> None:
 
     for version in ["v4", "v6"]:
         ipset_name = sets[version]
-        ip_version = "inet6" if version == "v6" else "inet"
-        create_or_reset_ipset(ipset_name, version, dry_run)
-
-        cidr_list = []
-        for start, end in parse_dataset(FILES[version], asn):
-            for net in iprange_to_cidr(start, end):
-                cidr = str(net)
-                add_ip_to_ipset(ipset_name, cidr, dry_run=dry_run)
-                cidr_list.append(cidr)
+        cidr_list = collect_cidrs(version, asn)
+        populate_ipset(ipset_name, version, cidr_list, dry_run=dry_run)
 
         if firewall == "iptables":
-            cmd = BIN_IPTABLES if version == "v4" else BIN_IP6TABLES
-            apply_iptables_rule(cmd, ipset_name, dry_run=dry_run)
+            cmd = BIN_IPTABLES_RESTORE if version == "v4" else BIN_IP6TABLES_RESTORE
+            apply_iptables_rules(cmd, [ipset_name], dry_run=dry_run)
         elif firewall == "firewalld":
             apply_firewalld_rule(ipset_name, dry_run=dry_run)
         elif firewall == "ufw":
             apply_ufw_rule(cidr_list, dry_run=dry_run)
 
+    if firewall == "firewalld":
+        reload_firewalld(dry_run=dry_run)
+
 def cleanup_ipsets(asn: int, dry_run: bool = False) -> None:
     print("--- Cleaning up block rules ---")
     if not validate_asn(asn):
@@ -237,24 +445,26 @@ def cleanup_ipsets(asn: int, dry_run: bool = False) -> None:
 
     for version in ["v4", "v6"]:
         ipset_name = f"ASN{asn}_{version}"
-        cidr_list = []
-
-        for start, end in parse_dataset(FILES[version], asn):
-            for net in iprange_to_cidr(start, end):
-                cidr_list.append(str(net))
 
+        # iptables and firewalld rules only name the ipset; just ufw needs the CIDRs back
         if firewall == "iptables":
-            cmd = BIN_IPTABLES if version == "v4" else BIN_IP6TABLES
-            remove_iptables_rule(cmd, ipset_name, dry_run=dry_run)
+            cmd = BIN_IPTABLES_RESTORE if version == "v4" else BIN_IP6TABLES_RESTORE
+            remove_iptables_rules(cmd, [ipset_name], dry_run=dry_run)
         elif firewall == "firewalld":
             remove_firewalld_rule(ipset_name, dry_run=dry_run)
         elif firewall == "ufw":
-            remove_ufw_rule(cidr_list, dry_run=dry_run)
+            remove_ufw_rule(collect_cidrs(version, asn), dry_run=dry_run)
+
+    if firewall == "firewalld":
+        reload_firewalld(dry_run=dry_run)
 
+    for version in ["v4", "v6"]:
+        ipset_name = f"ASN{asn}_{version}"
+        cmd = [BIN_IPSET, "destroy", ipset_name]
         if dry_run:
-            print(f"[DRY-RUN] Would run: {BIN_IPSET} destroy {ipset_name}")
+            print(f"[DRY-RUN] Would run: {shlex.join(cmd)}")
         else:
-            subprocess.run([BIN_IPSET, "destroy", ipset_name], stderr=subprocess.DEVNULL)
+            subprocess.run(cmd, stderr=subprocess.DEVNULL)
             logger.info(f"Removed ipset and rules for {ipset_name}")
 
 def main() -> None: